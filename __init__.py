@@ -1,4 +1,9 @@
+import functools
+import os
+import stat
 import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import NamedTuple
 from xml.etree import ElementTree
@@ -20,8 +25,13 @@ md_description = 'List and open JetBrains IDE projects'
 md_url = 'https://github.com/stevenxxiu/albert_jetbrains_projects_steven'
 md_maintainers = '@stevenxxiu'
 
+EXISTS_CACHE_TTL = 2.0  # Seconds
+EMPTY_QUERY_LIMIT = 20
+
 ICON_URL = f'file:{Path(__file__).parent / "icons/jetbrains.svg"}'
-JETBRAINS_XDG_CONFIG_DIR = Path.home() / '.config/JetBrains'
+HOME_STR = str(Path.home())
+# A `str`, as it's only passed to `os` functions
+JETBRAINS_XDG_CONFIG_DIR = os.path.join(HOME_STR, '.config/JetBrains')
 
 
 class IdeConfig(NamedTuple):
@@ -36,11 +46,61 @@ IDE_CONFIGS: dict[str, IdeConfig] = {
 }
 
 
-class IdeProject(NamedTuple):
-    name: str
-    path: Path
-    app_name: str
-    timestamp: int
+class IdeProjects:
+    """
+    Recent projects of all IDEs, as parallel lists indexed by project. Strings used when querying are computed once.
+    """
+
+    def __init__(self):
+        self.names: list[str] = []
+        self.paths: list[Path] = []
+        self.path_strs: list[str] = []
+        self.parent_strs: list[str] = []
+        self.app_names: list[str] = []
+        self.timestamps: list[int] = []
+        self.icon_names: list[str] = []
+        self.desktop_files: list[str] = []
+        # Project indices, the most recently accessed first
+        self.timestamp_order: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def append(self, name: str, path: Path, app_name: str, timestamp: int, ide_config: IdeConfig) -> None:
+        self.names.append(name)
+        self.paths.append(path)
+        self.path_strs.append(str(path))
+        self.parent_strs.append(str(path.parent))
+        self.app_names.append(app_name)
+        self.timestamps.append(timestamp)
+        self.icon_names.append(ide_config.icon_name)
+        self.desktop_files.append(ide_config.desktop_file)
+
+    def sort_by_timestamp(self) -> None:
+        self.timestamp_order = sorted(range(len(self)), key=self.timestamps.__getitem__, reverse=True)
+
+    def refresh_names(self, indices: list[int]) -> None:
+        """
+        `.idea/.name` can change without the xml changing, so re-resolve the names of the projects about to be used.
+        """
+        for i in indices:
+            self.names[i] = get_project_name(self.paths[i])
+
+
+# Reads the files of each IDE concurrently. The GIL is released while waiting on the filesystem.
+_executor = ThreadPoolExecutor(max_workers=len(IDE_CONFIGS), thread_name_prefix=__name__)
+
+# `app_name -> (config dir mtime, xml path)`
+_config_cache: dict[str, tuple[int, Path | None]] = {}
+
+# `xml path -> (mtime, size, recent projects)`
+_xml_cache: dict[Path, tuple[int, int, list[tuple[int, Path]]]] = {}
+
+# `project path -> (time checked, exists)`
+_exists_cache: dict[Path, tuple[float, bool]] = {}
+
+# `project path -> (.idea/.name mtime, project name)`
+_name_cache: dict[Path, tuple[int, str]] = {}
 
 
 def get_recent_projects(path: Path) -> list[tuple[int, Path]]:
@@ -48,28 +108,48 @@ def get_recent_projects(path: Path) -> list[tuple[int, Path]]:
     :param path: Parse the xml at `path`.
     :return: All recent project paths and the time they were last open.
     """
-    root: ElementTree.Element = ElementTree.parse(path).getroot()
-    additional_info: ElementTree.Element | None = None
+    # The xml only changes when an IDE opens or closes a project
+    xml_stat = path.stat()
+    cached = _xml_cache.get(path)
+    if cached is not None and cached[:2] == (xml_stat.st_mtime_ns, xml_stat.st_size):
+        return cached[2]
+
+    # Stream the xml, so only the tags we need are kept in memory. The section is the enclosing top-level
+    # `<option name="...">`, either `recentPaths` or `additionalInfo`.
+    root: ElementTree.Element | None = None
+    section: str | None = None
+    # `additionalInfo` entries have the real timestamp. Paths only in `recentPaths` default to `0`. Either section can
+    # come first.
     path_to_timestamp: dict[str, int] = {}
-    for option_tag in root[0]:
-        match option_tag.attrib['name']:
-            case 'recentPaths':
-                for recent_path in option_tag[0]:
-                    path_to_timestamp[recent_path.attrib['value']] = 0
-            case 'additionalInfo':
-                additional_info = option_tag[0]  # `<map>`
-
-    # For all `additionalInfo` entries, also add the real timestamp
-    if additional_info is not None:
-        for entry_tag in additional_info:
-            for option_tag in entry_tag[0][0]:
-                if option_tag.tag == 'option' and option_tag.attrib.get('name', None) == 'projectOpenTimestamp':
-                    path_to_timestamp[entry_tag.attrib['key']] = int(option_tag.attrib['value'])
-
-    return [
-        (timestamp, Path(path.replace('$USER_HOME$', str(Path.home()))))
-        for path, timestamp in path_to_timestamp.items()
-    ]
+    for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event == 'start':
+            if elem.tag == 'option' and elem.attrib.get('name', None) in ('recentPaths', 'additionalInfo'):
+                section = elem.attrib['name']
+            continue
+        match elem.tag:
+            case 'entry' if section == 'additionalInfo':
+                option_tag = elem.find("./value/RecentProjectMetaInfo/option[@name='projectOpenTimestamp']")
+                if option_tag is not None:
+                    path_to_timestamp[elem.attrib['key']] = int(option_tag.attrib['value'])
+                elem.clear()
+            case 'option' if section is not None and elem.attrib.get('name', None) == section:
+                if section == 'recentPaths':
+                    list_tag = elem.find('list')
+                    if list_tag is not None:
+                        for option_tag in list_tag.iter('option'):
+                            path_to_timestamp.setdefault(option_tag.attrib['value'], 0)
+                section = None
+                elem.clear()
+    if root is not None:
+        root.clear()
+
+    recent_projects: list[tuple[int, Path]] = []
+    for path_str, timestamp in path_to_timestamp.items():
+        recent_projects.append((timestamp, Path(path_str.replace('$USER_HOME$', HOME_STR))))
+    _xml_cache[path] = (xml_stat.st_mtime_ns, xml_stat.st_size, recent_projects)
+    return recent_projects
 
 
 def find_config_path(app_name: str) -> Path | None:
@@ -77,9 +157,18 @@ def find_config_path(app_name: str) -> Path | None:
     :param app_name:
     :return: The actual path to the relevant xml file, of the most recent configuration directory.
     """
-    xdg_dir: Path = JETBRAINS_XDG_CONFIG_DIR
-    if not xdg_dir.is_dir():
+    xdg_dir: str = JETBRAINS_XDG_CONFIG_DIR
+    try:
+        xdg_stat = os.stat(xdg_dir)
+    except OSError:
         return None
+    if not stat.S_ISDIR(xdg_stat.st_mode):
+        return None
+
+    # Adding or removing a configuration directory changes the parent's mtime
+    cached = _config_cache.get(app_name)
+    if cached is not None and cached[0] == xdg_stat.st_mtime_ns:
+        return cached[1]
 
     # Dirs contains possibly multiple directories for a program, e.g.
     #
@@ -87,78 +176,182 @@ def find_config_path(app_name: str) -> Path | None:
     # - `~/.config/JetBrains/PyCharm2022.1/`
     #
     # Take the newest.
-    try:
-        dir_name: Path = max(f for f in xdg_dir.iterdir() if (xdg_dir / f).is_dir() and f.name.startswith(app_name))
-    except ValueError:
-        return None
-    return xdg_dir / dir_name / 'options/recentProjects.xml'
+    # `DirEntry.is_dir()` uses the type cached by `scandir()`, so no extra `stat()` is needed per entry. It's checked
+    # last, only for entries which would become the newest.
+    newest: os.DirEntry | None = None
+    with os.scandir(xdg_dir) as it:
+        for entry in it:
+            if not entry.name.startswith(app_name):
+                continue
+            if (newest is None or entry.name > newest.name) and entry.is_dir():
+                newest = entry
+    config_path = None if newest is None else Path(newest.path) / 'options/recentProjects.xml'
+    _config_cache[app_name] = (xdg_stat.st_mtime_ns, config_path)
+    return config_path
 
 
 def get_project_name(path: Path) -> str:
+    name_path = path / '.idea/.name'
+    try:
+        mtime_ns = os.stat(name_path).st_mtime_ns
+    except OSError:
+        return path.name
+    cached = _name_cache.get(path)
+    if cached is not None and cached[0] == mtime_ns:
+        return cached[1]
+
+    # The file is tiny, so read it in one go without a buffered file object
     try:
-        with (path / '.idea/.name').open('r') as sr:
-            return sr.read()
-    except IOError:
+        fd = os.open(name_path, os.O_RDONLY)
+        try:
+            name = os.read(fd, 4096).decode()
+        finally:
+            os.close(fd)
+    except (OSError, UnicodeDecodeError):
         return path.name
+    _name_cache[path] = (mtime_ns, name)
+    return name
+
+
+def find_existing_paths(paths: list[Path]) -> set[Path]:
+    """
+    :param paths:
+    :return: The subset of `paths` which exist. Each distinct parent directory is listed once, instead of calling
+        `stat()` on every path. Results are reused for `EXISTS_CACHE_TTL` seconds, so a typing burst only checks once.
+    """
+    now = time.monotonic()
+    existing: set[Path] = set()
+    parent_to_paths: dict[Path, list[Path]] = {}
+    for path in paths:
+        cached = _exists_cache.get(path)
+        if cached is not None and now - cached[0] < EXISTS_CACHE_TTL:
+            if cached[1]:
+                existing.add(path)
+            continue
+        parent_to_paths.setdefault(path.parent, []).append(path)
+
+    for parent, children in parent_to_paths.items():
+        try:
+            with os.scandir(parent) as it:
+                names = {entry.name for entry in it}
+        except FileNotFoundError:
+            names = set()
+        except OSError:
+            # The parent may be searchable but not readable
+            names = {path.name for path in children if path.exists()}
+        for path in children:
+            exists = path.name in names
+            _exists_cache[path] = (now, exists)
+            if exists:
+                existing.add(path)
+    return existing
+
+
+def read_ide_projects(config_path: Path) -> list[tuple[str, Path, int]]:
+    """
+    :param config_path: The IDE's `recentProjects.xml`.
+    :return: The name, path and timestamp of each recent project.
+    """
+    return [(get_project_name(path), path, timestamp) for timestamp, path in get_recent_projects(config_path)]
 
 
 class Plugin(PluginInstance, TriggerQueryHandler):
     def __init__(self):
         TriggerQueryHandler.__init__(self, id=__name__, name=md_name, description=md_description, defaultTrigger='jb ')
         PluginInstance.__init__(self)
+        self._projects_key: tuple[tuple[Path, int], ...] | None = None
+        self._projects = IdeProjects()
 
-    def handleTriggerQuery(self, query) -> None:
-        matcher = Matcher(query.string)
-
-        projects: list[IdeProject] = []
-
-        for app_name in IDE_CONFIGS:
+    def _gather_projects(self) -> IdeProjects:
+        """
+        :return: All recent projects of all IDEs. Re-parsed only when one of the xml files changes.
+        """
+        config_paths: list[tuple[str, Path]] = []
+        key: list[tuple[Path, int]] = []
+        for app_name, ide_config in IDE_CONFIGS.items():
+            # Projects without a desktop file can't be opened, so aren't listed
+            if not ide_config.desktop_file:
+                continue
             config_path = find_config_path(app_name)
             if config_path is None:
                 continue
-            projects.extend(
-                [
-                    IdeProject(get_project_name(path), path, app_name, timestamp)
-                    for timestamp, path in get_recent_projects(config_path)
-                ]
-            )
+            try:
+                mtime_ns = os.stat(config_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            config_paths.append((app_name, config_path))
+            key.append((config_path, mtime_ns))
+
+        if tuple(key) != self._projects_key:
+            projects = IdeProjects()
+            ide_projects = _executor.map(read_ide_projects, [config_path for _, config_path in config_paths])
+            for (app_name, _), app_projects in zip(config_paths, ide_projects):
+                ide_config = IDE_CONFIGS[app_name]
+                for name, path, timestamp in app_projects:
+                    projects.append(name, path, app_name, timestamp, ide_config)
+            projects.sort_by_timestamp()
+            self._projects_key = tuple(key)
+            self._projects = projects
+            _exists_cache.clear()
+        return self._projects
 
-        # List all projects or the one corresponding to the query
-        projects = [project for project in projects if matcher.match(str(project.path))]
+    def handleTriggerQuery(self, query) -> None:
+        # An empty query matches everything, and ranks purely by timestamp. Otherwise, match each distinct string once,
+        # as projects open in several IDEs share paths, and projects often share parents.
+        match: Callable[[str], bool] | None = None
+        if query.string:
+            matcher = Matcher(query.string)
+            match = functools.cache(lambda text: bool(matcher.match(text)))
 
-        # The projects accessed the most recently comes first
-        projects.sort(key=lambda project: -project.timestamp)
+        projects = self._gather_projects()
 
-        projects_with_score = []
-        for i, project in enumerate(projects):
-            score = (1 - i) / len(projects)
-            if matcher.match(project.name):
-                score += 2.0
-            if matcher.match(str(project.path.parent)):
-                score += 1.0
-            projects_with_score.append((project, score))
-        projects_with_score.sort(key=lambda t: t[1], reverse=True)
+        indices: list[int] = []
+        order = projects.timestamp_order
+        if match is None:
+            # List the most recent projects only, checking existence batch by batch until there are enough
+            for start in range(0, len(order), EMPTY_QUERY_LIMIT):
+                batch = order[start : start + EMPTY_QUERY_LIMIT]
+                existing_paths = find_existing_paths([projects.paths[i] for i in batch])
+                indices.extend(i for i in batch if projects.paths[i] in existing_paths)
+                if len(indices) >= EMPTY_QUERY_LIMIT:
+                    del indices[EMPTY_QUERY_LIMIT:]
+                    break
+            projects.refresh_names(indices)
+        else:
+            # List the projects corresponding to the query. The projects accessed the most recently comes first.
+            order = [i for i in order if match(projects.path_strs[i])]
+            projects.refresh_names(order)
 
-        now = int(time.time() * 1000.0)
+            # `scores[rank]` is the score of `order[rank]`
+            scores: list[float] = []
+            for rank, i in enumerate(order):
+                score = (1 - rank) / len(order)
+                if match(projects.names[i]):
+                    score += 2.0
+                if match(projects.parent_strs[i]):
+                    score += 1.0
+                scores.append(score)
+            order = [order[rank] for rank in sorted(range(len(order)), key=scores.__getitem__, reverse=True)]
 
-        last_update: int
-        project_path: Path
-        app_name: str
-        for (project_name, project_path, app_name, last_update), _ in projects_with_score:
-            if not project_path.exists():
-                continue
-            desktop_file = IDE_CONFIGS[app_name].desktop_file
-            if not desktop_file:
-                continue
+            existing_paths = find_existing_paths([projects.paths[i] for i in order])
+            indices = [i for i in order if projects.paths[i] in existing_paths]
+
+        now = int(time.time() * 1000.0)
+        for i in indices:
+            project_path = projects.paths[i]
+            app_name = projects.app_names[i]
+            last_update = projects.timestamps[i]
+            desktop_file = projects.desktop_files[i]
 
+            item_id = f'{md_name}/{now - last_update:015d}/{projects.path_strs[i]}/{app_name}'
             item = StandardItem(
-                id=f'{md_name}/{now - last_update:015d}/{project_path}/{app_name}',
-                text=project_name,
-                subtext=str(project_path),
-                iconUrls=[IDE_CONFIGS[app_name].icon_name, ICON_URL],
+                id=item_id,
+                text=projects.names[i],
+                subtext=projects.path_strs[i],
+                iconUrls=[projects.icon_names[i], ICON_URL],
                 actions=[
                     Action(
-                        f'{md_name}/{now - last_update:015d}/{project_path}/{app_name}',
+                        item_id,
                         f'Open in {app_name}',
                         lambda desktop_file_=desktop_file, project_path_=project_path: runDetachedProcess(
                             ['gtk-launch', desktop_file_, str(project_path_)]